@@ -5,8 +5,13 @@ from proxy import CCProxy, CCProxyConfig
 
 
 def main():
-    df = pl.read_csv(f"{Path.cwd()}/data/sample.csv")
-    urls = df["website"].unique()
+    urls = (
+        pl.scan_csv(f"{Path.cwd()}/data/sample.csv")
+        .select(pl.col("website").unique())
+        .collect()
+        .to_series()
+        .to_list()
+    )
 
     proxy = CCProxy(
         CCProxyConfig(
@@ -1,16 +1,32 @@
-import json
+import asyncio
+import gzip
+import io
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from urllib.parse import quote_plus
 from pathlib import Path
-import re
 
+import diskcache
+import httpx
+import lz4.frame
+import orjson
 import polars as pl
-import requests
-from bs4 import BeautifulSoup
-from warcio.archiveiterator import ArchiveIterator
+from fastwarc.warc import ArchiveIterator, WarcRecordType
+from selectolax.lexbor import LexborHTMLParser
 
 CC_INIT_YR = 2014
+# WARC records larger than this are downloaded as parallel sub-ranges
+RANGE_SPLIT_THRESHOLD = 512 * 1024
+RANGE_SPLIT_PARTS = 4
+# Only the fields _fetch needs are requested from the index server
+CDX_FIELDS = "filename,offset,length"
+# The index server can take well over httpx's 5 s default to answer
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=30.0)
+# Sentinel for cache lookups, since None is a valid cached index answer
+CACHE_MISS = object()
+# Crawl names look like 'February/March 2024 Index'
+CRAWL_NAME_PATTERN = r"^(?P<month>[^ ]+) (?P<year>\d+)(?: |$)"
 
 
 @dataclass
@@ -20,12 +36,22 @@ class CCProxyConfig:
     target_months: list[str]
     year_range: range = range(CC_INIT_YR, datetime.now().year + 1)
     savepath: str = f"{Path.cwd()}/records"
+    # Number of URLs queried and fetched concurrently per index
+    max_concurrency: int = 32
+    # Threads used for WARC parsing and text extraction
+    max_workers: int = 16
 
 
 class CCProxy:
     def __init__(self, cfg: CCProxyConfig):
         self._cfg = cfg
-        self.server = "http://index.commoncrawl.org"
+        self.server = "https://index.commoncrawl.org"
+        self.data_server = "https://data.commoncrawl.org"
+        # Never evict: the default 1 GiB cap would let WARC payloads push out
+        # the small index answers; delete the directory to reclaim space
+        self.cache = diskcache.Cache(
+            f"{self.cfg.savepath}/.httpcache", eviction_policy="none"
+        )
         self.idxs = self._init_idxs()
         self.records = {}
 
@@ -37,8 +63,11 @@ class CCProxy:
         """For each year in the configured year range, this method
         searches Common Crawl indexes for the provided URLs, retrieves the
         archived HTML content, and extracts clean text using
-        BeautifulSoup. The extracted text is stored in DataFrames
-        organized by year.
+        selectolax. Up to cfg.max_concurrency URLs are in flight at once,
+        with index queries multiplexed over HTTP/2 and WARC ranges spread
+        over a pool of HTTP/1.1 connections, while WARC parsing and text
+        extraction run on a pool of cfg.max_workers threads. The extracted
+        text is stored in DataFrames organized by year.
 
         Args:
             urls: List of URLs to search for and process. Each URL should
@@ -48,41 +77,132 @@ class CCProxy:
             - Populates self.records with DataFrames containing URL and content pairs
             - Creates empty DataFrames for years with no successful retrievals
         """
-        for yr, idx in self.idxs.items():
-            df = pl.DataFrame(schema=["url", "content"])
-            for u in urls:
-                records = self._query(u, idx)
-                if records:
-                    page = self._fetch(records)
-                    if page is not None:
-                        try:
-                            soup = BeautifulSoup(page, "html.parser")
-                            text = soup.get_text(strip=True, separator=" ")
-                            if text:
-                                # INSERT VALIDATION CODE HERE
-                                row = pl.DataFrame([u, text], schema=df.schema)
-                                df = df.vstack(row)
-                        except Exception as e:
-                            print(f"Error parsing HTML for url {u}: {e}")
-            self.records[yr] = df
-            savepath = Path(self.cfg.savepath)
-            savepath.mkdir(exist_ok=True)
-            if len(df) > 0:
-                filename = savepath / f"{yr}.csv"
-                df.write_csv(filename)
-                print(f"Saved {len(df)} records for {yr} to {filename}")
+        asyncio.run(self._build_records_async(urls))
+
+    async def _build_records_async(self, urls: list[str]):
+        """Runs build_records() on an event loop. See build_records()."""
+        headers = {"user-agent": self.cfg.agent_decl}
+        sem = asyncio.Semaphore(self.cfg.max_concurrency)
+        # HTTP/2 multiplexes every request onto one connection, which suits
+        # the small index answers. WARC ranges stay on HTTP/1.1 so that
+        # concurrent (sub-)ranges really use separate connections, since a
+        # single connection to the data server is throughput-limited.
+        index_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100),
+            headers=headers,
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+        )
+        data_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+            headers=headers,
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+        )
+        with ThreadPoolExecutor(max_workers=self.cfg.max_workers) as executor:
+            async with index_client as index_session, data_client as data_session:
+
+                async def process(url: str, idx: str) -> tuple[str, str] | None:
+                    async with sem:
+                        return await self._process(
+                            index_session, data_session, executor, url, idx
+                        )
+
+                for yr, idx in self.idxs.items():
+                    rows = await asyncio.gather(*(process(u, idx) for u in urls))
+                    rows = [row for row in rows if row is not None]
+                    df = pl.DataFrame(
+                        rows,
+                        schema={"url": pl.Utf8, "content": pl.Utf8},
+                        orient="row",
+                    )
+                    self.records[yr] = df
+                    savepath = Path(self.cfg.savepath)
+                    savepath.mkdir(exist_ok=True)
+                    if len(df) > 0:
+                        filename = savepath / f"{yr}.parquet"
+                        df.write_parquet(
+                            filename,
+                            compression="zstd",
+                            compression_level=3,
+                            statistics=True,
+                        )
+                        print(f"Saved {len(df)} records for {yr} to {filename}")
+
+    async def _process(
+        self,
+        index_session: httpx.AsyncClient,
+        data_session: httpx.AsyncClient,
+        executor: ThreadPoolExecutor,
+        url: str,
+        idx: str,
+    ) -> tuple[str, str] | None:
+        """Query, fetch and extract the text of a single URL for one index.
+
+        Args:
+            index_session: The shared HTTP/2 client for index queries.
+            data_session: The shared HTTP/1.1 client for WARC ranges.
+            executor: Thread pool that CPU-bound parsing is offloaded to, so
+                it does not stall the event loop.
+            url: The URL to look up in the index.
+            idx: The Common Crawl index ID to search, e.g. 'CC-MAIN-2024-33'.
+
+        Returns:
+            A (url, text) row, or None if the URL was not found, could not
+            be fetched, or yielded no text.
+        """
+        try:
+            records = await self._query(index_session, executor, url, idx)
+            if not records:
+                return None
+            page = await self._fetch(data_session, executor, records)
+        except httpx.HTTPError as e:
+            print(f"Error requesting url {url}: {e}")
+            return None
+        if page is None:
+            return None
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(executor, self._extract_text, url, page)
+        if text:
+            # INSERT VALIDATION CODE HERE
+            return url, text
+        return None
+
+    def _extract_text(self, url: str, page: bytes) -> str | None:
+        """Extracts the visible text of an HTML page, ignoring scripts and
+        styles.
+
+        Args:
+            url: The URL the page was archived from, used in error messages.
+            page: The raw HTML content.
+
+        Returns:
+            The page text, or None if the HTML could not be parsed.
+        """
+        try:
+            # Let lexbor detect the charset from a BOM or <meta> tag
+            tree = LexborHTMLParser(page, encoding=True)
+            for node in tree.css("script,style"):
+                node.decompose()
+            root = tree.body or tree.root
+            return root.text(separator=" ", strip=True) if root else ""
+        except Exception as e:
+            print(f"Error parsing HTML for url {url}: {e}")
+        return None
 
     def save(self):
-        """Save all collected records as separate CSV files organized by year.
+        """Save all collected records as separate Parquet files organized by year.
 
         Creates the configured save directory if it doesn't exist and writes each
-        year's DataFrame to a CSV file named after the year. Only saves DataFrames
-        that contain data (length > 0).
+        year's DataFrame to a zstd-compressed Parquet file named after the year.
+        Only saves DataFrames that contain data (length > 0).
 
         File Structure:
             - Creates directory at self.cfg.savepath if it doesn't exist
-            - Saves files as: {savepath}/{year}.csv
-            - Each CSV contains columns: ["url", "content"]
+            - Saves files as: {savepath}/{year}.parquet
+            - Each file contains columns: ["url", "content"]; read them back
+              with pl.scan_parquet
 
         Note:
             This method should be called after build_records() has populated
@@ -92,8 +212,10 @@ class CCProxy:
         savepath.mkdir(exist_ok=True)
         for year, df in self.records.items():
             if len(df) > 0:
-                filename = savepath / f"{year}.csv"
-                df.write_csv(filename)
+                filename = savepath / f"{year}.parquet"
+                df.write_parquet(
+                    filename, compression="zstd", compression_level=3, statistics=True
+                )
                 print(f"Saved {len(df)} records for {year} to {filename}")
 
     def _init_idxs(self):
@@ -110,101 +232,285 @@ class CCProxy:
                         Only includes years that have crawls from the target month.
 
         Note:
-            - Exits the program if unable to access Common Crawl API
-            - Handles malformed date strings gracefully by checking length
-            - Continues processing if individual crawl records are malformed
+            - Exits the program if unable to access Common Crawl API and
+              no cached copy of collinfo.json exists
+            - Crawls whose name lacks a numeric year are dropped
+            - When a year has several matching crawls, the earliest is used
         """
-        crawls = {}
-        idxs = {}
-        response = None
+        if not self.cfg.target_months:
+            return {}
+        collinfo = self._get_collinfo()
+        if collinfo is None:
+            return {}
+        crawls = pl.read_json(io.BytesIO(collinfo))
+        if crawls.is_empty():
+            return {}
+        name = pl.col("name").str.extract_groups(CRAWL_NAME_PATTERN)
+        idxs = (
+            crawls.lazy()
+            .select(
+                "id",
+                name.struct.field("month"),
+                name.struct.field("year").cast(pl.Int32),
+            )
+            .filter(
+                pl.col("year").is_in(list(self.cfg.year_range))
+                & pl.any_horizontal(
+                    pl.col("month").str.contains(m, literal=True)
+                    for m in self.cfg.target_months
+                )
+            )
+            # collinfo.json lists the newest crawl first
+            .reverse()
+            .unique(subset="year", keep="first", maintain_order=True)
+            .collect()
+        )
+        return dict(zip(idxs["year"], idxs["id"]))
+
+    def _get_collinfo(self) -> bytes | None:
+        """Retrieves collinfo.json, revalidating a cached copy when present.
+
+        The list only changes when Common Crawl publishes a new crawl, so
+        the body is cached together with its ETag and Last-Modified headers
+        and the request is made conditional. A 304 reply carries no body and
+        the cached copy is used instead.
+
+        Returns:
+            The raw collinfo.json content, or None if the server returned
+            an error and nothing is cached.
+
+        Note:
+            - Falls back to the cached copy if the server cannot be reached
+            - Exits the program if it cannot be reached and nothing is cached
+        """
+        cached = self.cache.get("collinfo")
+        headers = {"user-agent": self.cfg.agent_decl}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
         try:
-            response = requests.get(
+            response = httpx.get(
                 f"{self.server}/collinfo.json",
-                headers={"user-agent": self.cfg.agent_decl},
+                headers=headers,
+                timeout=HTTP_TIMEOUT,
+                follow_redirects=True,
             )
         except Exception as e:
             print(f"Error accessing Common Crawl indexes: {e}")
-            exit(1)
-        if response.status_code == 200:
-            crawls = response.json()
-        for c in reversed(crawls):
-            id = c["id"]
-            if "name" in c:
-                month, year = c["name"].split(" ")[:2]
-                if not year.isdigit():
-                    continue
-                year = int(year)
-                for m in self.cfg.target_months:
-                    if m in month and year in self.cfg.year_range and year not in idxs:
-                        idxs[year] = id
-                        break
-        return idxs
-
-    def _query(self, url: str, idx: str):
+            if cached is None:
+                exit(1)
+            return cached["content"]
+        if response.status_code == 304 and cached is not None:
+            return cached["content"]
+        if response.status_code != 200:
+            return None if cached is None else cached["content"]
+        self.cache["collinfo"] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content": response.content,
+        }
+        return response.content
+
+    async def _query(
+        self,
+        session: httpx.AsyncClient,
+        executor: ThreadPoolExecutor,
+        url: str,
+        idx: str,
+    ):
         """Queries the Common Crawl index API to find all archived records for
         a given URL.
 
         Args:
+            session: The shared HTTP/2 client for index queries.
+            executor: Thread pool that blocking cache I/O is offloaded to.
             url: The URL to search for in the Common Crawl index. Should be a
                 complete URL including protocol (e.g., 'https://example.com').
+            idx: The Common Crawl index ID to search, e.g. 'CC-MAIN-2024-33'.
 
         Returns:
             A list of dictionaries containing record metadata if the URL is
-            found in the index. Each dictionary includes fields like 'offset',
-            'length', 'filename', 'timestamp', etc. Returns None if the URL is
-            not found or if the API request fails.
+            found in the index. Each dictionary holds the CDX_FIELDS 'filename',
+            'offset' and 'length'. Returns None if the URL has no captures
+            with HTTP status 200 or if the API request fails.
+
+        Note:
+            Found and not-found answers are cached on disk, since a
+            published index never changes; failed requests are retried.
         """
+        loop = asyncio.get_running_loop()
+        key = f"cdx:{idx}:{url}"
+        cached = await loop.run_in_executor(executor, self.cache.get, key, CACHE_MISS)
+        if cached is not CACHE_MISS:
+            return cached
         encoded_url = quote_plus(url)
-        index_url = f"{self.server}/{idx}-index?url={encoded_url}&output=json"
-        response = requests.get(index_url, headers={"user-agent": self.cfg.agent_decl})
+        # Filter to successful captures and project the needed fields on the
+        # server, so redirects and error pages are neither sent nor parsed
+        index_url = (
+            f"{self.server}/{idx}-index?url={encoded_url}&output=json"
+            f"&fl={CDX_FIELDS}&filter==status:200"
+        )
+        response = await session.get(index_url)
         if response.status_code == 200:
-            records = response.text.strip().split("\n")
-            return [json.loads(record) for record in records]
+            records = [orjson.loads(r) for r in response.content.split(b"\n") if r]
+        elif response.status_code == 404:
+            records = None
         else:
             return None
+        await loop.run_in_executor(executor, self.cache.set, key, records)
+        return records
 
-    def _fetch(self, records: list[dict]) -> str:
+    async def _fetch(
+        self,
+        session: httpx.AsyncClient,
+        executor: ThreadPoolExecutor,
+        records: list[dict],
+    ) -> bytes:
         """Given a list of Common Crawl record metadata, attempts to retrieve
         the actual HTML content from the first successfully accessible record.
         Uses byte-range requests to efficiently download only the specific
         archived page data.
 
         Args:
-            records: A list of record dictionaries returned from search_cc_index().
+            session: The shared HTTP/1.1 client for WARC ranges.
+            executor: Thread pool that WARC parsing and cache I/O are
+                offloaded to.
+            records: A list of record dictionaries returned from _query().
                     Each record must contain 'offset', 'length', and 'filename' keys.
 
         Returns:
-            The decoded HTML content of the first successfully retrieved page
-            as a UTF-8 string. Returns None if no records can be successfully
-            retrieved or if all requests fail.
+            The raw HTML content of the first successfully retrieved page as
+            bytes, left undecoded for the HTML parser to sniff its encoding.
+            Returns None if no records can be successfully retrieved or if
+            all requests fail.
 
         Note:
-            - Only processes 'response' type WARC records
-            - Handles encoding issues by using 'ignore' error handling
+            - Only 'response' type WARC records are parsed; FastWARC skips
+              all other record types without materializing them
+            - Successfully parsed records are cached on disk LZ4-compressed
+              and read from there on later runs
+            - Duplicate and empty records are skipped, and the remaining
+              records are tried from smallest to largest
+            - Records over RANGE_SPLIT_THRESHOLD are downloaded as
+              RANGE_SPLIT_PARTS concurrent sub-ranges on separate
+              connections, since a single connection to the data server is
+              throughput-limited
         """
-        for record in records:
+        loop = asyncio.get_running_loop()
+        # Captures with the same (filename, offset, length) are the same bytes
+        unique = {
+            (r["filename"], r["offset"], r["length"]): r
+            for r in records
+            if int(r["length"]) > 0
+        }
+        for record in sorted(unique.values(), key=lambda r: int(r["length"])):
             offset, length = int(record["offset"]), int(record["length"])
-            s3_url = f"https://data.commoncrawl.org/{record['filename']}"
-            # Define the byte range for the request
-            byte_range = f"bytes={offset}-{offset + length - 1}"
-            # NOTE: Use `stream=True` to get a raw byte stream since the
-            # response returns gzip compressed data
-            response = requests.get(
-                s3_url,
-                headers={"user-agent": self.cfg.agent_decl, "Range": byte_range},
-                stream=True,
+            s3_url = f"{self.data_server}/{record['filename']}"
+            key = f"warc:{record['filename']}:{offset}:{length}"
+            cached = await loop.run_in_executor(executor, self.cache.get, key)
+            if cached is not None:
+                html_content = await loop.run_in_executor(
+                    executor, self._read_warc, io.BytesIO(cached)
+                )
+                if html_content is not None:
+                    return html_content
+            # The exact record length is known from the index, so download
+            # straight into a buffer of that size, one slice per sub-range
+            data = bytearray(length)
+            view = memoryview(data)
+            part_size = length
+            if length > RANGE_SPLIT_THRESHOLD:
+                part_size = -(-length // RANGE_SPLIT_PARTS)
+            fetched = await asyncio.gather(
+                *(
+                    self._fetch_range(
+                        session, s3_url, offset + start, view[start : start + part_size]
+                    )
+                    for start in range(0, length, part_size)
+                )
             )
-            if response.status_code == 206:
-                try:
-                    stream = ArchiveIterator(response.raw)
-                    for warc_record in stream:
-                        if warc_record.rec_type == "response":
-                            html_content = warc_record.content_stream().read()
-                            if isinstance(html_content, bytes):
-                                html_content = html_content.decode(
-                                    "utf-8", errors="ignore"
-                                )
-                            return html_content
-                except Exception as e:
-                    print(f"Error processing WARC record: {e}")
+            if not all(fetched):
+                continue
+            html_content = await loop.run_in_executor(
+                executor, self._read_warc, io.BytesIO(data)
+            )
+            if html_content is not None:
+                await loop.run_in_executor(executor, self._cache_warc, key, data)
+                return html_content
         return None
+
+    def _cache_warc(self, key: str, data: bytearray):
+        """Stores a gzipped WARC record LZ4-compressed, so cache hits skip zlib.
+
+        Caching is best effort: a record that does not decompress cleanly or
+        a failed write (e.g. a full disk) is logged and otherwise ignored.
+        """
+        try:
+            self.cache[key] = lz4.frame.compress(gzip.decompress(data))
+        except Exception as e:
+            print(f"Error caching WARC record {key}: {e}")
+
+    def _read_warc(self, stream) -> bytes | None:
+        """Extracts the HTTP payload of the first 'response' record in a WARC
+        stream. FastWARC detects gzip or LZ4 compression on its own.
+
+        Args:
+            stream: A file-like object or path holding the WARC record.
+
+        Returns:
+            The raw payload bytes, or None if the stream has no response
+            record or cannot be parsed.
+        """
+        try:
+            stream = ArchiveIterator(
+                stream,
+                record_types=WarcRecordType.response,
+                parse_http=True,
+            )
+            for warc_record in stream:
+                return warc_record.reader.read()
+        except Exception as e:
+            print(f"Error processing WARC record: {e}")
+        return None
+
+    async def _fetch_range(
+        self, session: httpx.AsyncClient, s3_url: str, offset: int, buf: memoryview
+    ) -> bool:
+        """Download a byte range of a WARC file in a single request, reading
+        it directly into a preallocated buffer.
+
+        Args:
+            session: The shared HTTP/1.1 client for WARC ranges.
+            s3_url: URL of the WARC file on the data server.
+            offset: Byte offset of the range within the WARC file.
+            buf: Writable buffer whose length is the size of the range.
+
+        Returns:
+            True if the whole range was read into buf, False if the request
+            failed or the body came back short.
+        """
+        byte_range = f"bytes={offset}-{offset + len(buf) - 1}"
+        # Streaming closes the response as soon as the range is read, which
+        # returns its connection to the client's pool
+        try:
+            async with session.stream(
+                "GET", s3_url, headers={"Range": byte_range}
+            ) as response:
+                if response.status_code != 206:
+                    return False
+                n = 0
+                # Raw chunks keep the gzip encoding intact for FastWARC and are
+                # copied into buf as they arrive, without re-chunking
+                async for chunk in response.aiter_raw():
+                    end = n + len(chunk)
+                    if end > len(buf):
+                        return False
+                    buf[n:end] = chunk
+                    n = end
+                return n == len(buf)
+        except httpx.HTTPError as e:
+            # Fail only this capture, so _fetch moves on to the next record
+            print(f"Error fetching {byte_range} of {s3_url}: {e}")
+            return False